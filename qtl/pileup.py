@@ -3,10 +3,11 @@ import numpy as np
 import glob
 import os
 import subprocess
-import contextlib
-import multiprocessing as mp
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+from matplotlib.collections import PolyCollection
 from matplotlib.colors import hsv_to_rgb
 import seaborn as sns
 from cycler import cycler
@@ -15,73 +16,157 @@ from . import stats, annotation
 from . import plot as qtl_plot
 from . import genotype as gt
 
+try:  # multithreaded CSV parsing, if available
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
 
-@contextlib.contextmanager
-def cd(cd_path):
-    saved_path = os.getcwd()
-    os.chdir(cd_path)
-    yield
-    os.chdir(saved_path)
+
+@dataclass(eq=False)
+class PileupBlock:
+    """Read depths over a region, stored as a (positions x samples) int32 array"""
+    chrom: str
+    start: int
+    positions: np.ndarray
+    depths: np.ndarray
+    samples: list
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.depths, index=pd.Index(self.positions, name='position'), columns=self.samples)
 
 
 def _samtools_depth_wrapper(args):
     """
-    Wrapper for `samtools depth`.
+    Wrapper for `samtools depth` on a batch of BAMs.
+
+    Returns a DataFrame with columns pos and one depth column per BAM.
+    Since the region is reported with -a -a, positions are identical across BAMs.
+    The chromosome column is constant within a region and is not parsed.
 
     For files on GCP, GCS_OAUTH_TOKEN must be set.
     This can be done with qtl.refresh_gcs_token().
     """
-    bam_file, region_str, sample_id, bam_index_dir, depth = args
+    bam_files, region_str, sample_ids, bam_index_dir, depth = args
+
+    cmd = ['samtools', 'depth', '-a', '-a', '-d', str(depth), '-Q', '255', '-r', region_str] + list(bam_files)
+    return _read_depth(cmd, sample_ids, cwd=bam_index_dir)
+
+
+def _read_depth(cmd, sample_ids, cwd=None):
+    """Parse `samtools depth` output directly from the subprocess stream"""
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1<<20, cwd=cwd)
+    dtype = {i:np.int32 for i in ['pos']+list(sample_ids)}
+    names = ['chr', 'pos']+list(sample_ids)
+    try:
+        if pa is not None:
+            df = pa_csv.read_csv(p.stdout, read_options=pa_csv.ReadOptions(column_names=names),
+                                 parse_options=pa_csv.ParseOptions(delimiter='\t'),
+                                 convert_options=pa_csv.ConvertOptions(include_columns=list(dtype),
+                                                                       column_types={i:pa.int32() for i in dtype})).to_pandas()
+        else:
+            df = pd.read_csv(p.stdout, sep='\t', header=None, names=names,
+                             usecols=list(dtype), dtype=dtype, engine='c')
+    finally:
+        # on failure samtools writes nothing to stdout; report its exit status instead of the parser error
+        p.stdout.close()
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+    return df
 
-    cmd = f'export GCS_OAUTH_TOKEN=$GCS_OAUTH_TOKEN; samtools depth -a -a -d {depth} -Q 255 -r {region_str} {bam_file}'
-    if bam_index_dir is not None:
-        with cd(bam_index_dir):
-            c = subprocess.check_output(cmd, shell=True).decode().strip().split('\n')
-    else:
-        c = subprocess.check_output(cmd, shell=True).decode().strip().split('\n')
 
-    df = pd.DataFrame([i.split('\t') for i in c], columns=['chr', 'pos', sample_id])
-    df.index = df['chr']+'_'+df['pos']
-    return df[sample_id].astype(np.int32)
+def _pysam_depth(bam_file, chrom, start, end, bam_index_dir=None):
+    """
+    Depth (sum of A/C/G/T counts) for reads with MAPQ 255, computed in-process with pysam.
+    As with `samtools depth`, unmapped, secondary, QC-fail and duplicate reads are excluded.
+    """
+    import pysam
+    index_filename = None
+    if bam_index_dir is not None:
+        ext = '.crai' if bam_file.endswith('.cram') else '.bai'
+        index_filename = os.path.join(bam_index_dir, os.path.basename(bam_file)+ext)
+    with pysam.AlignmentFile(bam_file, index_filename=index_filename, threads=2) as f:
+        a, c, g, t = f.count_coverage(chrom, start-1, end, quality_threshold=0,
+                                      read_callback=lambda r: r.mapping_quality == 255 and not r.flag & 0x704)
+    return np.add(np.add(a, c), np.add(g, t), dtype=np.int32)
 
 
-def samtools_depth(region_str, bam_s, bam_index_dir=None, d=100000, num_threads=12):
+def samtools_depth(region_str, bam_s, bam_index_dir=None, d=100000, num_threads=12, batch_size=8, backend='samtools'):
     """
       region_str: string in 'chr:start-end' format
       bam_s: pd.Series or dict mapping sample_id->bam_path
       bam_index_dir: directory containing local copies of the BAM/CRAM indexes
+      num_threads: number of concurrent samtools processes
+      batch_size: maximum number of BAMs processed by a single samtools call;
+        reduced if needed so that all threads receive work
+      backend: 'samtools', or 'pysam' to count coverage in-process
+        (requires pysam; the max. depth d is not applied and N bases are not counted)
+
+    Returns a PileupBlock; use PileupBlock.to_dataframe() for a DataFrame.
     """
-    pileups_df = []
-    with mp.Pool(processes=num_threads) as pool:
-        for k,r in enumerate(pool.imap(_samtools_depth_wrapper, [(i,region_str,j,bam_index_dir,d) for j,i in bam_s.items()]), 1):
-            print(f'\r  * running samtools depth on region {region_str} for bam {k}/{len(bam_s)}', end='')
-            pileups_df.append(r)
-        print()
-    pileups_df = pd.concat(pileups_df, axis=1)
-    pileups_df.index.name = 'position'
-    return pileups_df
+    sample_ids = list(bam_s.keys())
+    bam_files = [bam_s[i] for i in sample_ids]
+
+    if backend == 'pysam':
+        chrom, rng = region_str.rsplit(':', 1)
+        start, end = [int(i) for i in rng.replace(',', '').split('-')]
+        pileups = np.empty((end-start+1, len(bam_files)), dtype=np.int32)
+        print(f'  * computing coverage on region {region_str} for {len(bam_s)} bams')
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for k,r in enumerate(executor.map(lambda x: _pysam_depth(x, chrom, start, end, bam_index_dir=bam_index_dir), bam_files)):
+                pileups[:, k] = r
+        return PileupBlock(chrom, start, np.arange(start, end+1, dtype=np.int32), pileups, sample_ids)
+    elif backend != 'samtools':
+        raise ValueError(f"Unsupported backend '{backend}'.")
+    batch_size = max(1, min(batch_size, int(np.ceil(len(sample_ids) / num_threads))))
+    shards = [np.arange(i, min(i+batch_size, len(sample_ids))) for i in range(0, len(sample_ids), batch_size)]
+    args = [([bam_files[i] for i in s], region_str, [sample_ids[i] for i in s], bam_index_dir, d) for s in shards]
+
+    # samtools runs in its own process; threads only wait on and parse its output
+    print(f'  * running samtools depth on region {region_str} for {len(bam_s)} bams in {len(shards)} batches')
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        dfs = list(executor.map(_samtools_depth_wrapper, args))
+
+    chrom = region_str.rsplit(':', 1)[0]
+    positions = dfs[0]['pos'].values
+    pileups = np.hstack([df[a[2]].values for df,a in zip(dfs, args)])
+    return PileupBlock(chrom, int(positions[0]) if len(positions) > 0 else None, positions, pileups, sample_ids)
 
 
 def norm_pileups(pileups_df, libsize_s, covariates_df=None, id_map=lambda x: '-'.join(x.split('-')[:2])):
     """
-      pileups_df: output from samtools_depth()
+      pileups_df: output from samtools_depth() (PileupBlock or DataFrame)
       libsize_s: pd.Series mapping sample_id->library size (total mapped reads)
     """
-    # convert pileups to reads per million
-    pileups_rpm_df = pileups_df / libsize_s[pileups_df.columns] * 1e6
-    pileups_rpm_df.rename(columns=id_map, inplace=True)
+    if isinstance(pileups_df, PileupBlock):
+        cols = pd.Index(pileups_df.samples)
+        index = pd.Index(pileups_df.positions, name='position')
+        depths = pileups_df.depths
+    else:
+        cols = pileups_df.columns
+        index = pileups_df.index
+        depths = pileups_df.to_numpy()
+
+    # convert pileups to reads per million (float32 is sufficient for RPM)
+    scale = (1e6 / libsize_s.loc[cols].to_numpy()).astype(np.float32)
+    rpm = depths.astype(np.float32)
+    np.multiply(rpm, scale, out=rpm)
+    cols_out = pd.Index([id_map(i) for i in cols])
+    if cols_out.has_duplicates:
+        raise ValueError(f'id_map produces duplicate IDs: {", ".join(map(str, cols_out[cols_out.duplicated()].unique()))}')
 
     if covariates_df is not None:
         residualizer = stats.Residualizer(covariates_df)
-        pileups_rpm_df = residualizer.transform(pileups_rpm_df)
+        rpm = residualizer.transform(rpm)
 
+    pileups_rpm_df = pd.DataFrame(rpm, index=index, columns=cols_out)
     return pileups_rpm_df
 
 
 def group_pileups(pileups_df, libsize_s, variant_id, genotypes, covariates_df=None,
                   id_map=lambda x: '-'.join(x.split('-')[:2])):
     """
-      pileups_df: output from samtools_depth()
+      pileups_df: output from samtools_depth() (PileupBlock or DataFrame)
       libsize_s: pd.Series mapping sample_id->library size (total mapped reads)
     """
     pileups_rpm_df = norm_pileups(pileups_df, libsize_s, covariates_df=covariates_df, id_map=id_map)
@@ -94,19 +179,25 @@ def group_pileups(pileups_df, libsize_s, variant_id, genotypes, covariates_df=No
     else:
         raise ValueError('Unsupported format for genotypes.')
 
-    # average pileups by genotype or category
-    cols = np.unique(g[g.notnull()]).astype(int)
-    df = pd.concat([pileups_rpm_df[g[g == i].index].mean(axis=1).rename(i) for i in cols], axis=1)
+    # average pileups by genotype or category, using a (samples x classes) averaging matrix
+    g = g.reindex(pileups_rpm_df.columns).dropna().astype(int)
+    inv, cols = pd.factorize(g, sort=True)
+    w = np.zeros((len(g), len(cols)), dtype=np.float32)
+    w[np.arange(len(g)), inv] = 1
+    w /= w.sum(0, keepdims=True)
+    df = pd.DataFrame(pileups_rpm_df[g.index].values.astype(np.float32) @ w,
+                      index=pileups_rpm_df.index, columns=cols)
     return df
 
 
 def plot(pileup_dfs, gene, mappability_bigwig=None, variant_id=None, order='additive',
          title=None, show_variant_pos=False, max_intron=300, alpha=1, lw=0.5,
          highlight_introns=None, highlight_introns2=None, shade_range=None,
-         ymax=None, xlim=None, rasterized=False, outline=False, labels=None,
+         ymax=None, xlim=None, rasterized=None, outline=False, labels=None,
          dl=0.75, aw=4.5, dr=0.5, db=0.5, ah=1.5, dt=0.25, ds=0.2):
     """
       pileup_dfs:
+      rasterized: rasterize pileup traces; if None, only regions longer than 2 kb are rasterized
     """
 
     if isinstance(pileup_dfs, pd.DataFrame):
@@ -169,14 +260,23 @@ def plot(pileup_dfs, gene, mappability_bigwig=None, variant_id=None, order='addi
 
     gene.set_plot_coords(max_intron=max_intron)
     xi = gene.map_pos(np.arange(gene.start_pos, gene.end_pos+1))
+    xticks = gene.map_pos(gene.ce.ravel())  # collapsed exon boundaries, set by set_plot_coords
+    if rasterized is None:
+        rasterized = len(xi) > 2000
 
+    colors = (custom_cycler if custom_cycler is not None else plt.rcParams['axes.prop_cycle']).by_key()['color']
+    plot_data = [{i: df[i].to_numpy() for i in sorder if i in df.columns} for df in pileup_dfs]
     for k,ax in enumerate(axv):
-        for i in sorder:
-            if i in pileup_dfs[k]:
-                if outline:
-                    ax.plot(xi, pileup_dfs[k][i], label=i, lw=lw, alpha=alpha, rasterized=rasterized)
-                else:
-                    ax.fill_between(xi, pileup_dfs[k][i], label=i, alpha=alpha, rasterized=rasterized)
+        if outline:
+            handles = []
+            for i,y in plot_data[k].items():
+                handles.extend(ax.plot(xi, y, label=i, lw=lw, alpha=alpha, rasterized=rasterized))
+        else:  # draw all filled pileups of the axis as a single collection
+            fc = [colors[j % len(colors)] for j in range(len(plot_data[k]))]
+            verts = [np.column_stack([np.r_[xi, xi[::-1]], np.r_[y, np.zeros(len(xi))]]) for y in plot_data[k].values()]
+            ax.add_collection(PolyCollection(verts, facecolors=fc, edgecolors='face', alpha=alpha, rasterized=rasterized))
+            ax.autoscale_view()
+            handles = [patches.Patch(facecolor=c, alpha=alpha, label=i) for i,c in zip(plot_data[k], fc)]
 
     if labels is None:
         labels = ['Mean RPM'] * num_pileups
@@ -185,7 +285,7 @@ def plot(pileup_dfs, gene, mappability_bigwig=None, variant_id=None, order='addi
         ax.set_ylabel(labels[k], fontsize=12)
         qtl_plot.format_plot(ax, fontsize=10, lw=0.6)
         ax.tick_params(axis='x', length=3, width=0.6, pad=1)
-        ax.set_xticks(gene.map_pos(gene.get_collapsed_coords().reshape(1,-1)[0]))
+        ax.set_xticks(xticks)
         ax.set_xticklabels([])
         ax.spines['left'].set_position(('outward', 6))
 
@@ -195,10 +295,10 @@ def plot(pileup_dfs, gene, mappability_bigwig=None, variant_id=None, order='addi
         ax.set_ylim([0, ymax])
 
     if gtlabels is None:
-        leg = axv[-1].legend(loc='lower left', labelspacing=0.15, frameon=False, fontsize=9, borderaxespad=0.5,
+        leg = axv[-1].legend(handles=handles, loc='lower left', labelspacing=0.15, frameon=False, fontsize=9, borderaxespad=0.5,
                              borderpad=0, handlelength=0.75, bbox_to_anchor=(0,1.05), ncol=3)
     else:
-        leg = axv[-1].legend(loc='upper left', labelspacing=0.15, frameon=False, fontsize=9, borderaxespad=0.5,
+        leg = axv[-1].legend(handles=handles, loc='upper left', labelspacing=0.15, frameon=False, fontsize=9, borderaxespad=0.5,
                              borderpad=0, handlelength=0.75, labels=gtlabels[sorder])
     for line in leg.get_lines():
         line.set_linewidth(1)
@@ -211,13 +311,14 @@ def plot(pileup_dfs, gene, mappability_bigwig=None, variant_id=None, order='addi
     # highlight variant
     if show_variant_pos and pos is not None and pos >= gene.start_pos and pos <= gene.end_pos:
         x = gene.map_pos(pos)
+        h = 0.04 * ah * 72  # triangle height: 4% of axis height, in points
+        # equilateral triangle pointing up, with its apex at the marker position;
+        # custom markers are scaled so that max(abs(verts)) = ms/2, hence ms=2*h
+        marker = [(-1/np.sqrt(3), -1), (1/np.sqrt(3), -1), (0, 0)]
         for ax in axv:
-            xlim = np.diff(ax.get_xlim())[0]
-            ylim = np.diff(ax.get_ylim())[0]
-            h = 0.04 * ylim
-            b = h/np.sqrt(3) * ah/aw * xlim/ylim
-            v = np.array([[x-b, -h-0.01*ylim], [x+b, -h-0.01*ylim], [x, -0.01*ylim]])
-            ax.add_patch(patches.Polygon(v, closed=True, color='r', clip_on=False, zorder=10))
+            # apex at 1% of the axis height below the x-axis (y in axes coordinates)
+            ax.plot(x, -0.01, marker=marker, ms=2*h, mew=0, color='r', clip_on=False, zorder=10,
+                    transform=ax.get_xaxis_transform())
 
     if shade_range is not None:
         if isinstance(shade_range, str):